@@ -1,9 +1,11 @@
 import streamlit as st
 from streamlit_option_menu import option_menu # Import the component
-from utils.state_manager import init_state
+from utils.state_manager import init_state, reset_chat
 from views.dashboard_page import render_page as render_dashboard
 from views.chat_page import render_page as render_chat
 from views.settings_page import render_page as render_settings
+from utils.database import get_all_sessions, get_db_version, load_chat_history_from_db, delete_session
+import uuid
 
 # Set page configuration
 st.set_page_config(
@@ -69,9 +71,6 @@ with st.sidebar:
     st.divider()
     
     # --- Session Management in Sidebar ---
-    from utils.database import get_all_sessions, load_chat_history_from_db, delete_session
-    import uuid
-    
     if selected_page == "Chat":
         st.subheader("💬 Chat History")
         
@@ -79,35 +78,47 @@ with st.sidebar:
         if st.button("➕ New Chat", use_container_width=True):
             new_id = str(uuid.uuid4())
             st.session_state.current_session_id = new_id
-            st.session_state.chat_messages = [] # Start blank
+            reset_chat() # Start blank
             st.rerun()
             
         st.markdown("---")
         
         # List recent sessions
-        sessions = get_all_sessions()
+        sessions = get_all_sessions(get_db_version())
         
+        # Single radio instead of two buttons per session keeps widget count flat.
+        # No key: its identity follows `index`, so switching sessions elsewhere resets it.
+        preview_map = {}
         for sess in sessions:
-            s_id = sess["session_id"]
-            last_msg = sess["user_prompt"][:40] + "..." if sess["user_prompt"] else "Empty Chat"
-            
-            # Highlight current session
-            btn_style = "primary" if s_id == st.session_state.get("current_session_id") else "secondary"
-            
-            col1, col2 = st.columns([0.8, 0.2])
-            with col1:
-                if st.button(f"{last_msg}", key=f"sess_{s_id}", use_container_width=True, help=s_id):
-                    st.session_state.current_session_id = s_id
-                    st.session_state.chat_messages = load_chat_history_from_db(s_id)
-                    st.rerun()
-            with col2:
-                if st.button("🗑", key=f"del_{s_id}"):
-                    delete_session(s_id)
-                    if s_id == st.session_state.get("current_session_id"):
-                        # Reset if deleting current
-                        st.session_state.current_session_id = str(uuid.uuid4())
-                        st.session_state.chat_messages = []
-                    st.rerun()
+            preview = sess["user_prompt"]
+            preview_map[sess["session_id"]] = (preview + ("..." if len(preview) == 40 else "")) if preview else "Empty Chat"
+        
+        session_ids = list(preview_map)
+        current_id = st.session_state.get("current_session_id")
+        current_idx = session_ids.index(current_id) if current_id in preview_map else None
+        # Read by the chat page: a new chat's first turn reruns so it shows up in this list
+        st.session_state.current_session_listed = current_idx is not None
+        
+        if session_ids:
+            choice = st.radio(
+                "Sessions",
+                options=session_ids,
+                format_func=lambda sid: preview_map[sid],
+                index=current_idx,
+                label_visibility="collapsed",
+            )
+            if choice is not None and choice != current_id:
+                st.session_state.current_session_id = choice
+                reset_chat(load_chat_history_from_db(choice))
+                st.rerun()
+        
+        if current_idx is not None:
+            if st.button("🗑 Delete current", use_container_width=True):
+                delete_session(current_id)
+                # Reset since we deleted the current session
+                st.session_state.current_session_id = str(uuid.uuid4())
+                reset_chat()
+                st.rerun()
     
     st.divider()
     
@@ -115,7 +126,7 @@ with st.sidebar:
     if selected_page == "Chat":
         if st.session_state.chat_messages: # Only show if history exists
             if st.sidebar.button("🗑️ Clear Chat History", width="stretch"):
-                st.session_state.chat_messages = []
+                reset_chat()
                 st.rerun()
 
 
@@ -1,7 +1,20 @@
 import streamlit as st
+import json
 import requests
+from functools import lru_cache
 from tavily import TavilyClient
 
+GROQ_CHAT_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+# Shared session so Groq calls reuse pooled keep-alive connections instead of
+# paying a TCP + TLS handshake on every request.
+_http = requests.Session()
+
+@lru_cache(maxsize=4)
+def _get_tavily_client(api_key: str):
+    """Returns a shared TavilyClient per API key."""
+    return TavilyClient(api_key=api_key)
+
 def run_tavily_search(query: str, search_depth: str = "advanced", result_count: int = 7, sites: list = None):
     """
     Executes a web search using the Tavily API with retry logic.
@@ -26,7 +39,7 @@ def run_tavily_search(query: str, search_depth: str = "advanced", result_count:
     
     for attempt in range(max_retries):
         try:
-            client = TavilyClient(api_key=api_key)
+            client = _get_tavily_client(api_key)
             params = {"query": query, "search_depth": search_depth, "max_results": result_count}
             
             if sites:
@@ -75,7 +88,6 @@ def ask_groq(messages: list, model: str, temperature: float):
     
     for attempt in range(max_retries):
         try:
-            url = "https://api.groq.com/openai/v1/chat/completions"
             headers = {
                 "Authorization": f"Bearer {api_key}", 
                 "Content-Type": "application/json"
@@ -86,7 +98,7 @@ def ask_groq(messages: list, model: str, temperature: float):
                 "temperature": temperature
             }
             
-            response = requests.post(url, headers=headers, json=data)
+            response = _http.post(GROQ_CHAT_URL, headers=headers, json=data)
             response.raise_for_status()
             
             response_json = response.json()
@@ -98,3 +110,66 @@ def ask_groq(messages: list, model: str, temperature: float):
             continue
             
     return f"Error querying Groq API after {max_retries} attempts: {last_error}"
+
+def ask_groq_stream(messages: list, model: str, temperature: float):
+    """
+    Streams a chat completion from the Groq API, yielding content deltas as they arrive.
+    Retries only if the request fails before the first token is received.
+    
+    Input:
+        messages (list): List of message dicts (role, content).
+        model (str): Groq model name.
+        temperature (float): Sampling temperature.
+        
+    Output:
+        generator: Yields str chunks of the assistant's response.
+    """
+    api_key = st.session_state.get("GROQ_API_KEY")
+    if not api_key:
+        yield "Error: Groq API key not set."
+        return
+        
+    max_retries = 3
+    last_error = None
+    
+    for attempt in range(max_retries):
+        started = False
+        try:
+            headers = {
+                "Authorization": f"Bearer {api_key}", 
+                "Content-Type": "application/json"
+            }
+            data = {
+                "messages": messages, 
+                "model": model, 
+                "temperature": temperature,
+                "stream": True
+            }
+            
+            with _http.post(GROQ_CHAT_URL, headers=headers, json=data, stream=True) as response:
+                response.raise_for_status()
+                # SSE is UTF-8 by spec; requests would otherwise guess ISO-8859-1 (or None) for text/*
+                response.encoding = "utf-8"
+                
+                # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    payload = line[len("data: "):]
+                    if payload == "[DONE]":
+                        return
+                    delta = json.loads(payload)["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        started = True
+                        yield delta
+            return
+            
+        except Exception as e:
+            if started:
+                # Can't retry without duplicating what the user already saw
+                yield f"\n\nError: Groq stream interrupted: {e}"
+                return
+            last_error = e
+            continue
+            
+    yield f"Error querying Groq API after {max_retries} attempts: {last_error}"
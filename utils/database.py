@@ -1,140 +1,407 @@
 import sqlite3
 import json
 import os
+import atexit
+import queue
+import threading
+import time
+import streamlit as st
 
 DB_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "interactions.db"))
 # Ensure we refer to DB_FILE correctly relative to CWD or absolute?
 # The original utils.py just used "interactions.db", implying CWD. We keep it same.
 
+# A single connection is shared by every Streamlit session thread.
+# All access goes through _lock since sqlite3 connections are not thread-safe.
+_conn = None
+_lock = threading.Lock()
+# Bumped on deletes, which MAX(id) alone would not reflect.
+_generation = 0
+
+# Interaction inserts are queued and committed in batches by a background writer.
+# IDs are reserved up front so callers get them back without waiting for the commit.
+_write_q = queue.Queue()
+_WRITE_BATCH_SIZE = 50
+# The writer truncates the WAL after this many commits or seconds, whichever comes first
+_CHECKPOINT_EVERY_COMMITS = 200
+_CHECKPOINT_EVERY_SECONDS = 60
+_next_id = None
+_initialized = False
+
+# Hot statements are kept as constants so the connection's statement cache
+# reuses the prepared statement instead of re-parsing the SQL on every call.
+_SQL_INSERT_INTERACTION = (
+    "INSERT INTO interactions (id, session_id, user_prompt, web_context, llm_response, source, sources) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+_SQL_UPDATE_RATING = "UPDATE interactions SET rating = ? WHERE id = ?"
+# Newest N rows for the session, returned oldest-first (id breaks same-second ties)
+_SQL_LOAD_HISTORY = """
+    SELECT * FROM (
+        SELECT * FROM interactions WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+    ) ORDER BY timestamp ASC, id ASC
+"""
+# One row per session: its latest interaction. Driven from the distinct sessions (an
+# idx_sess_ts scan) with one idx_sess_ts seek each, rather than a subquery per row.
+_SQL_ALL_SESSIONS = """
+    SELECT i.session_id, i.timestamp as last_active, substr(i.user_prompt, 1, 40) as user_prompt
+    FROM (SELECT DISTINCT session_id FROM interactions) s
+    JOIN interactions i ON i.id = (
+        SELECT id FROM interactions
+        WHERE session_id = s.session_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
+    )
+    ORDER BY last_active DESC, i.id DESC
+"""
+_SQL_DELETE_SESSION = "DELETE FROM interactions WHERE session_id = ?"
+
+def _get_conn():
+    """Returns the shared connection, opening and tuning it on first use."""
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA wal_autocheckpoint=1000")
+        _conn = conn
+        atexit.register(_close_conn)
+    return _conn
+
+def _checkpoint():
+    """Folds the WAL back into the main DB file and truncates it. Must be called with _lock held."""
+    try:
+        _get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception as e:
+        print(f"WAL checkpoint failed: {e}")
+
+def _write_rows_individually(rows):
+    """Inserts rows one transaction each, logging and dropping failures. Must be called with _lock held."""
+    committed = 0
+    conn = _get_conn()
+    for row in rows:
+        try:
+            conn.execute(_SQL_INSERT_INTERACTION, row)
+            conn.commit()
+            committed += 1
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"Failed to write interaction {row[0]}: {e}")
+    return committed
+
+def _writer_loop():
+    """Drains queued inserts, commits each batch in a single transaction and keeps the WAL bounded."""
+    commits_since_checkpoint = 0
+    last_checkpoint = time.monotonic()
+    while True:
+        try:
+            batch = [_write_q.get(timeout=_CHECKPOINT_EVERY_SECONDS)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < _WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        with _lock:
+            if batch:
+                try:
+                    conn = _get_conn()
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(_SQL_INSERT_INTERACTION, batch)
+                    conn.commit()
+                    commits_since_checkpoint += 1
+                except Exception as e:
+                    if _conn is not None and _conn.in_transaction:
+                        _conn.rollback()
+                    if len(batch) == 1:
+                        print(f"Failed to write interaction {batch[0][0]}: {e}")
+                    else:
+                        # Retry row by row so one bad row does not take the whole batch with it
+                        commits_since_checkpoint += _write_rows_individually(batch)
+            elapsed = time.monotonic() - last_checkpoint
+            if commits_since_checkpoint >= _CHECKPOINT_EVERY_COMMITS or (
+                commits_since_checkpoint and elapsed >= _CHECKPOINT_EVERY_SECONDS
+            ):
+                _checkpoint()
+                commits_since_checkpoint = 0
+                last_checkpoint = time.monotonic()
+        for _ in batch:
+            _write_q.task_done()
+
+def _flush_writes():
+    """Blocks until every queued write has been committed."""
+    _write_q.join()
+
+def _reserve_id():
+    """Returns the next interaction ID. Must be called with _lock held."""
+    global _next_id
+    if _next_id is None:
+        row = _get_conn().execute("""
+            SELECT MAX(
+                COALESCE((SELECT MAX(id) FROM interactions), 0),
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'interactions'), 0)
+            )
+        """).fetchone()
+        _next_id = row[0]
+    _next_id += 1
+    return _next_id
+
+threading.Thread(target=_writer_loop, name="interactions-writer", daemon=True).start()
+
+def _close_conn():
+    """Runs PRAGMA optimize and closes the shared connection at interpreter exit."""
+    global _conn
+    _flush_writes()
+    with _lock:
+        if _conn is None:
+            return
+        try:
+            _conn.execute("PRAGMA optimize")
+        finally:
+            _conn.close()
+            _conn = None
+
 def setup_database():
     """Create the database and table, with all necessary columns for persistence."""
-    os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Create table if not exists with new schema
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS interactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT DEFAULT 'default',
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            user_prompt TEXT NOT NULL,
-            web_context TEXT,
-            llm_response TEXT,
-            rating INTEGER DEFAULT 0,
-            source TEXT,
-            sources TEXT
-        )
-    """)
-    
-    # Migration: Check if session_id column exists
-    cursor.execute("PRAGMA table_info(interactions)")
-    columns = [info[1] for info in cursor.fetchall()]
-    if "session_id" not in columns:
-        cursor.execute("ALTER TABLE interactions ADD COLUMN session_id TEXT DEFAULT 'default'")
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.cursor()
         
-    conn.commit()
-    conn.close()
+        # Create table if not exists with new schema
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS interactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT DEFAULT 'default',
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                user_prompt TEXT NOT NULL,
+                web_context TEXT,
+                llm_response TEXT,
+                rating INTEGER DEFAULT 0,
+                source TEXT,
+                sources TEXT
+            )
+        """)
+        
+        # Migration: Check if session_id column exists
+        cursor.execute("PRAGMA table_info(interactions)")
+        columns = [info[1] for info in cursor.fetchall()]
+        if "session_id" not in columns:
+            cursor.execute("ALTER TABLE interactions ADD COLUMN session_id TEXT DEFAULT 'default'")
+
+        # Full-text index over prompts/responses, kept in sync by triggers
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'interactions_fts'")
+        fts_exists = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts
+            USING fts5(user_prompt, llm_response, content='interactions', content_rowid='id')
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS interactions_ai AFTER INSERT ON interactions BEGIN
+                INSERT INTO interactions_fts(rowid, user_prompt, llm_response)
+                VALUES (new.id, new.user_prompt, new.llm_response);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS interactions_ad AFTER DELETE ON interactions BEGIN
+                INSERT INTO interactions_fts(interactions_fts, rowid, user_prompt, llm_response)
+                VALUES ('delete', old.id, old.user_prompt, old.llm_response);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS interactions_au AFTER UPDATE OF user_prompt, llm_response ON interactions BEGIN
+                INSERT INTO interactions_fts(interactions_fts, rowid, user_prompt, llm_response)
+                VALUES ('delete', old.id, old.user_prompt, old.llm_response);
+                INSERT INTO interactions_fts(rowid, user_prompt, llm_response)
+                VALUES (new.id, new.user_prompt, new.llm_response);
+            END
+        """)
+        if not fts_exists:
+            # Backfill rows logged before the index existed
+            cursor.execute("INSERT INTO interactions_fts(interactions_fts) VALUES ('rebuild')")
+
+        # Indexes for per-session history and rating-ordered lookups
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_sess_ts'")
+        indexes_exist = cursor.fetchone() is not None
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sess_ts ON interactions(session_id, timestamp DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_rating_ts ON interactions(rating, timestamp DESC)")
+        if not indexes_exist:
+            # Gather planner stats once so the new indexes are actually chosen
+            cursor.execute("ANALYZE")
+            
+        conn.commit()
+        # Cheap no-op unless table stats have drifted enough to need a re-ANALYZE
+        conn.execute("PRAGMA optimize")
+
+def optimize_database():
+    """Analyzes every table regardless of recent usage so query plans stay current."""
+    _flush_writes()
+    with _lock:
+        _get_conn().execute("PRAGMA optimize=0x10002")
 
 def log_interaction(user_prompt: str, web_context: str, llm_response: str, source: str, sources: list, session_id: str = "default"):
-    """Logs a complete user interaction to the database and returns its ID."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    """
+    Queues a complete user interaction for logging and returns its ID.
+    The row is committed asynchronously; readers flush the queue before querying.
+    """
     sources_json = json.dumps(sources)
-    cursor.execute(
-        "INSERT INTO interactions (session_id, user_prompt, web_context, llm_response, source, sources) VALUES (?, ?, ?, ?, ?, ?)",
-        (session_id, user_prompt, web_context, llm_response, source, sources_json)
-    )
-    interaction_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with _lock:
+        interaction_id = _reserve_id()
+    _write_q.put((interaction_id, session_id, user_prompt, web_context, llm_response, source, sources_json))
     return interaction_id
 
 def update_interaction_rating(interaction_id: int, rating: int):
     """Updates the rating for a specific interaction."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE interactions SET rating = ? WHERE id = ?", (rating, interaction_id))
-    conn.commit()
-    conn.close()
+    _flush_writes()
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.cursor()
+        cursor.execute(_SQL_UPDATE_RATING, (rating, interaction_id))
+        conn.commit()
+
+def _fts_query(text: str) -> str:
+    """Builds an FTS5 MATCH expression that ANDs the quoted tokens of `text`."""
+    return " ".join('"' + token.replace('"', '""') + '"' for token in text.split())
 
 def find_similar_interaction(query: str):
     """Finds a similar, highly-rated past interaction from the database."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT user_prompt, llm_response 
-        FROM interactions 
-        WHERE user_prompt LIKE ? AND rating >= 1
-        ORDER BY rating DESC, timestamp DESC
-        LIMIT 1
-        """,
-        (f'%{query.strip()}%',)
-    )
-    result = cursor.fetchone()
-    conn.close()
+    if not query or not query.strip():
+        return None
+    match = _fts_query(query)
+    _flush_writes()
+    with _lock:
+        cursor = _get_conn().cursor()
+        cursor.execute(
+            """
+            SELECT i.user_prompt, i.llm_response 
+            FROM interactions_fts
+            JOIN interactions i ON i.id = interactions_fts.rowid
+            WHERE interactions_fts MATCH ? AND i.rating >= 1
+            ORDER BY i.rating DESC, i.timestamp DESC
+            LIMIT 1
+            """,
+            (f"user_prompt : ({match})",)
+        )
+        result = cursor.fetchone()
     if result:
         return {"past_question": result["user_prompt"], "past_answer": result["llm_response"]}
     return None
 
+class LazySources:
+    """
+    List-like wrapper around a stored `sources` JSON string.
+    The JSON is only decoded when the sources are actually iterated or indexed.
+    """
+    __slots__ = ("_raw", "_parsed")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._parsed = None
+
+    def _items(self):
+        if self._parsed is None:
+            self._parsed = json.loads(self._raw) if self._raw else []
+        return self._parsed
+
+    def __bool__(self):
+        # Avoid decoding just to answer "are there any sources?"
+        if self._parsed is not None:
+            return bool(self._parsed)
+        return bool(self._raw) and self._raw != "[]"
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+    def __getitem__(self, index):
+        return self._items()[index]
+
+def _user_message(row):
+    return {"role": "user", "content": row["user_prompt"]}
+
+def _assistant_message(row):
+    return {
+        "role": "assistant",
+        "content": row["llm_response"],
+        "source": row["source"],
+        "sources": LazySources(row["sources"]),
+        "interaction_id": row["id"]
+    }
+
 def load_chat_history_from_db(session_id: str = "default", limit: int = 50):
-    """Loads the last N interactions for a specific session."""
-    if not os.path.exists(DB_FILE): return []
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM interactions WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?", (session_id, limit))
-    rows = cursor.fetchall()
-    conn.close()
-    messages = []
-    for row in reversed(rows):
-        messages.append({"role": "user", "content": row["user_prompt"]})
-        messages.append({
-            "role": "assistant",
-            "content": row["llm_response"],
-            "source": row["source"],
-            "sources": json.loads(row["sources"]) if row["sources"] else [],
-            "interaction_id": row["id"]
-        })
+    """Loads the last N interactions for a specific session, oldest first."""
+    _flush_writes()
+    with _lock:
+        cursor = _get_conn().cursor()
+        cursor.execute(_SQL_LOAD_HISTORY, (session_id, limit))
+        messages = [m for row in cursor for m in (_user_message(row), _assistant_message(row))]
     return messages
 
-def get_all_sessions():
-    """Returns a list of all distinct sessions with their last update time."""
-    if not os.path.exists(DB_FILE): return []
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    # Group by session and get the snippet of the first (latest) message
-    cursor.execute("""
-        SELECT session_id, MAX(timestamp) as last_active, user_prompt 
-        FROM interactions 
-        GROUP BY session_id 
-        ORDER BY last_active DESC
-    """)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+def get_db_version():
+    """
+    Returns a cheap token that changes whenever sessions are added or removed.
+    Used as the cache key for get_all_sessions.
+    """
+    _flush_writes()
+    with _lock:
+        max_id = _get_conn().execute("SELECT COALESCE(MAX(id), 0) FROM interactions").fetchone()[0]
+    return (max_id, _generation)
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_all_sessions(version=None):
+    """
+    Returns a list of all distinct sessions with their last update time.
+    `user_prompt` is truncated to 40 characters in SQL since it is only used as a preview.
+    Pass get_db_version() as `version` so the cached result is refreshed on change.
+    """
+    _flush_writes()
+    with _lock:
+        cursor = _get_conn().cursor()
+        # Get each session with the snippet of its latest message
+        cursor.execute(_SQL_ALL_SESSIONS)
+        rows = cursor.fetchall()
+    # sqlite3.Row is not picklable, so hand st.cache_data plain dicts
+    return [dict(row) for row in rows]
 
 def delete_session(session_id: str):
     """Deletes all interactions for a given session."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM interactions WHERE session_id = ?", (session_id,))
-    conn.commit()
-    conn.close()
+    global _generation
+    _flush_writes()
+    with _lock:
+        conn = _get_conn()
+        cursor = conn.cursor()
+        # The interactions_ad trigger removes the matching FTS rows in the same transaction
+        cursor.execute(_SQL_DELETE_SESSION, (session_id,))
+        conn.commit()
+        _generation += 1
 
 def load_query_history_from_db(limit: int = 10):
     """Loads the last N user prompts from the DB for the dashboard."""
-    if not os.path.exists(DB_FILE): return []
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_prompt FROM interactions ORDER BY timestamp DESC LIMIT ?", (limit,))
-    rows = cursor.fetchall()
-    conn.close()
+    _flush_writes()
+    with _lock:
+        cursor = _get_conn().cursor()
+        cursor.execute("SELECT user_prompt FROM interactions ORDER BY timestamp DESC LIMIT ?", (limit,))
+        rows = cursor.fetchall()
     # We create a history list compatible with the dashboard dataframe
     # For now, we assume 'RAG Agent' for DB items as they come from the chat page
     # In a full app, we would store the type in the DB.
     history = [{"Query": row[0], "Type": "RAG Agent"} for row in rows]
     return history
+
+def _ensure():
+    """Creates/migrates the database once per process so readers can skip existence checks."""
+    global _initialized
+    if not _initialized:
+        setup_database()
+        _initialized = True
+
+_ensure()
@@ -17,13 +17,26 @@ def process_uploaded_file(uploaded_file):
     """
     if uploaded_file is None:
         return []
+    return process_file_bytes(uploaded_file.name, uploaded_file.getvalue())
 
-    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+def process_file_bytes(file_name, data):
+    """
+    Same as process_uploaded_file, from a file name and its raw bytes.
+    Takes only picklable arguments, so it can run in a ProcessPoolExecutor worker.
+    
+    Input:
+        file_name (str): Original file name; its extension picks the loader.
+        data (bytes): The file content.
+        
+    Output:
+        list: A list of LangChain Document objects with metadata (source, page).
+    """
+    file_extension = os.path.splitext(file_name)[1].lower()
     documents = []
 
     # Create a temporary file to save the uploaded content because LangChain loaders often need a file path
     with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
+        tmp_file.write(data)
         tmp_file_path = tmp_file.name
 
     try:
@@ -42,7 +55,7 @@ def process_uploaded_file(uploaded_file):
                 # First try pandas for a simpler text representation
                 df = pd.read_excel(tmp_file_path)
                 text_content = df.to_string()
-                documents = [Document(page_content=text_content, metadata={"source": uploaded_file.name, "page": 1})]
+                documents = [Document(page_content=text_content, metadata={"source": file_name, "page": 1})]
             except Exception:
                 # Fallback to loader
                 loader = UnstructuredExcelLoader(tmp_file_path)
@@ -55,7 +68,7 @@ def process_uploaded_file(uploaded_file):
             try:
                 with open(tmp_file_path, "r", encoding="utf-8") as f:
                     text = f.read()
-                documents = [Document(page_content=text, metadata={"source": uploaded_file.name, "page": 1})]
+                documents = [Document(page_content=text, metadata={"source": file_name, "page": 1})]
             except Exception:
                 pass
     finally:
@@ -74,9 +87,9 @@ def process_uploaded_file(uploaded_file):
         # Ensure source metadata is preserved/set
         for doc in split_docs:
             if "source" not in doc.metadata:
-                doc.metadata["source"] = uploaded_file.name
+                doc.metadata["source"] = file_name
             else:
-                doc.metadata["source"] = f"{uploaded_file.name} - {doc.metadata.get('source', '')}"
+                doc.metadata["source"] = f"{file_name} - {doc.metadata.get('source', '')}"
         return split_docs
     
     return []
@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
 
 PROMPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "prompts")
 
+@lru_cache(maxsize=32)
 def load_prompt(filename: str) -> str:
-    """Loads a prompt from the prompts directory."""
+    """Loads a prompt from the prompts directory. Results are cached for the process lifetime."""
     path = os.path.join(PROMPTS_DIR, filename)
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -1,4 +1,11 @@
+import asyncio
 import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+import groq
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
@@ -6,12 +13,136 @@ from pydantic import BaseModel, Field
 from utils.constants import RetrievalStrategy
 from utils.prompt_loader import load_prompt
 
+# Pattern to find URLs
+_URL_RE = re.compile(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+')
+
+# Only these are worth backing off and retrying; auth, bad-model and bad-request errors
+# fail the same way every time.
+_TRANSIENT_ERRORS = (groq.RateLimitError, groq.APIConnectionError, groq.APITimeoutError)
+
+# Phrase heuristics mirroring retriever_strategies.txt, checked in order as
+# (pattern, strategy, needs_knowledge_base). Only unambiguous phrases are listed; bare
+# words like "search" or "file" also show up in coding/general questions, so anything
+# else falls through to the LLM router.
+_HEURISTIC_ROUTES = [
+    (re.compile(r'\b(uploaded (documents?|files?|pdfs?)|(this|these|attached) (documents?|files?|pdfs?)|summari[sz]e this)\b', re.I),
+     RetrievalStrategy.VECTOR_BASED, True),
+    (re.compile(r'\b(search (the web|online|the internet|google) for|latest news|news (about|on) today|stock price (of|for)|weather (in|for|today))\b', re.I),
+     RetrievalStrategy.WEB_SEARCH, False),
+]
+
+# Short definition-style prompts ("what is X?") go straight to the LLM, but only when
+# there is no knowledge base; otherwise the answer may well be in the uploaded docs.
+_DIRECT_LLM_RE = re.compile(r'^\s*(what is|who is|define|explain|how does)\b', re.I)
+_DIRECT_LLM_MAX_WORDS = 8
+
+# Process-local LRU caches for successful router/grader results, so re-asking or
+# rerunning (🔄) the same query skips both LLM calls. Failures are never cached.
+_DECISION_CACHE = OrderedDict()
+_GRADE_CACHE = OrderedDict()
+_CACHE_SIZE = 512
+_cache_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+def _cache_put(cache, key, value):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > _CACHE_SIZE:
+            cache.popitem(last=False)
+
+@lru_cache(maxsize=1)
+def _build_strategies_text():
+    """Formats the strategies prompt with the enum values (both are immutable at runtime)."""
+    strategies_template = load_prompt("retriever_strategies.txt")
+    return strategies_template.format(
+        direct_llm=RetrievalStrategy.DIRECT_LLM.value,
+        vector_based=RetrievalStrategy.VECTOR_BASED.value,
+        hybrid=RetrievalStrategy.HYBRID.value,
+        web_search=RetrievalStrategy.WEB_SEARCH.value
+    )
+
 class RetrieverDecision(BaseModel):
     strategy: str = Field(description="The chosen retrieval strategy.")
     reasoning: str = Field(description="Explanation of why this strategy was chosen based on the query and retriever types.")
     refined_query: str = Field(description="A refined version of the query optimized for the chosen strategy.")
 
-def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192"):
+# Parsers are stateless, and the format instructions only depend on the schema above
+_PARSER = JsonOutputParser(pydantic_object=RetrieverDecision)
+_FORMAT_INSTR = _PARSER.get_format_instructions()
+_GRADER_PARSER = JsonOutputParser()
+
+@lru_cache(maxsize=4)
+def _get_llm(api_key, model_name):
+    """Returns a shared ChatGroq client so its HTTP connection pool is reused across calls."""
+    return ChatGroq(temperature=0, groq_api_key=api_key, model_name=model_name)
+
+@lru_cache(maxsize=4)
+def _get_router_chain(api_key, model_name):
+    """Builds the router chain once per (api_key, model)."""
+    router_system_template = load_prompt("retriever_router_system.txt")
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", router_system_template),
+        ("user", "Query: {query}\n\n{format_instructions}")
+    ])
+    return prompt | _get_llm(api_key, model_name) | _PARSER
+
+@lru_cache(maxsize=4)
+def _get_grader_chain(api_key, model_name):
+    """Builds the document grader chain once per (api_key, model)."""
+    prompt = ChatPromptTemplate.from_template(load_prompt("retrieval_grader.txt"))
+    return prompt | _get_llm(api_key, model_name) | _GRADER_PARSER
+
+def quick_route(user_query, has_knowledge_base=True):
+    """
+    Decides the retrieval strategy locally (URLs, then phrase heuristics), without an LLM call.
+    The Vector-Based route needs `has_knowledge_base`; the Direct LLM one only applies without it.
+
+    Output:
+        dict | None: A decision shaped like get_retriever_decision()'s, or None when
+        the query needs the LLM router.
+    """
+    # 0. Regex Check for URLs (search first, most queries have none)
+    urls = _URL_RE.findall(user_query) if _URL_RE.search(user_query) else []
+    
+    if urls:
+        return {
+            "strategy": RetrievalStrategy.WEB_SEARCH.value,
+            "reasoning": f"User query contains specific URLs: {urls}. Switching to Web Search.",
+            "refined_query": user_query,
+            "urls": urls # Pass extracted URLs
+        }
+
+    # 1. Phrase heuristics
+    for pattern, strategy, needs_knowledge_base in _HEURISTIC_ROUTES:
+        if needs_knowledge_base and not has_knowledge_base:
+            continue
+        match = pattern.search(user_query)
+        if match:
+            return {
+                "strategy": strategy.value,
+                "reasoning": f"heuristic: matched '{match.group(0)}'.",
+                "refined_query": user_query
+            }
+
+    if not has_knowledge_base:
+        match = _DIRECT_LLM_RE.match(user_query)
+        if match and len(user_query.split()) <= _DIRECT_LLM_MAX_WORDS:
+            return {
+                "strategy": RetrievalStrategy.DIRECT_LLM.value,
+                "reasoning": f"heuristic: matched '{match.group(1)}' with no knowledge base.",
+                "refined_query": user_query
+            }
+
+    return None
+
+def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192", has_knowledge_base=True):
     """
     Analyzes the user query and decides the best retrieval strategy using an LLM.
 
@@ -19,6 +150,7 @@ def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192"):
         user_query (str): The user's search query.
         api_key (str): Groq API Key.
         model_name (str): The Groq model to use.
+        has_knowledge_base (bool): Whether a vector store exists; see quick_route().
 
     Output:
         dict: A dictionary containing:
@@ -33,53 +165,33 @@ def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192"):
         "refined_query": user_query
     }
 
-    # 0. Regex Check for URLs
-    import re
-    # Pattern to find URLs
-    url_pattern = r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+'
-    urls = re.findall(url_pattern, user_query)
-    
-    if urls:
-        return {
-            "strategy": RetrievalStrategy.WEB_SEARCH.value,
-            "reasoning": f"User query contains specific URLs: {urls}. Switching to Web Search.",
-            "refined_query": user_query,
-            "urls": urls # Pass extracted URLs
-        }
+    decision = quick_route(user_query, has_knowledge_base)
+    if decision is not None:
+        return decision
 
     if not api_key:
         fallback_decision["reasoning"] = "No API key provided."
         return fallback_decision
 
+    cache_key = (user_query, api_key, model_name)
+    cached = _cache_get(_DECISION_CACHE, cache_key)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        llm = ChatGroq(temperature=0, groq_api_key=api_key, model_name=model_name)
-        
-        parser = JsonOutputParser(pydantic_object=RetrieverDecision)
+        chain = _get_router_chain(api_key, model_name)
         
         # Dynamic Prompt using Enum values
-        strategies_template = load_prompt("retriever_strategies.txt")
-        strategies_text = strategies_template.format(
-            direct_llm=RetrievalStrategy.DIRECT_LLM.value,
-            vector_based=RetrievalStrategy.VECTOR_BASED.value,
-            hybrid=RetrievalStrategy.HYBRID.value,
-            web_search=RetrievalStrategy.WEB_SEARCH.value
-        )
-        
-        router_system_template = load_prompt("retriever_router_system.txt")
+        strategies_text = _build_strategies_text()
         retriever_knowledge_base = load_prompt("retriever_knowledge_base.txt")
         
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", router_system_template),
-            ("user", "Query: {query}\n\n{format_instructions}")
-        ])
-        
-        chain = prompt | llm | parser
-        
-        # Retry logic
+        # Retry logic with exponential backoff for transient (e.g. rate limit) errors
         max_retries = 3
         last_error = None
+        attempts = 0
         
         for attempt in range(max_retries):
+            attempts = attempt + 1
             try:
                 decision = chain.invoke({
                     "strategies_text": strategies_text,
@@ -88,19 +200,26 @@ def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192"):
                     "direct_strategy": RetrievalStrategy.DIRECT_LLM.value,
                     "web_strategy": RetrievalStrategy.WEB_SEARCH.value,
                     "query": user_query,
-                    "format_instructions": parser.get_format_instructions()
+                    "format_instructions": _FORMAT_INSTR
                 })
                 # Validate strategy is known
                 if decision.get("strategy") not in [s.value for s in RetrievalStrategy]:
                      decision["strategy"] = RetrievalStrategy.VECTOR_BASED.value # Default to safe option if hallucinated
+                _cache_put(_DECISION_CACHE, cache_key, dict(decision))
                 return decision
-            except Exception as e:
+            except _TRANSIENT_ERRORS as e:
                 last_error = e
+                if attempt < max_retries - 1:
+                    time.sleep(0.25 * (2 ** attempt))
                 continue
+            except Exception as e:
+                # Parser errors at temperature 0, 401/404/400 etc. won't improve on an identical retry
+                last_error = e
+                break
         
         # Fallback if retries fail
         fallback_decision["strategy"] = RetrievalStrategy.DIRECT_LLM.value
-        fallback_decision["reasoning"] = f"Agent decision failed after {max_retries} attempts: {str(last_error)}"
+        fallback_decision["reasoning"] = f"Agent decision failed after {attempts} attempts: {str(last_error)}"
         return fallback_decision
 
     except Exception as e:
@@ -109,30 +228,53 @@ def get_retriever_decision(user_query, api_key, model_name="llama3-8b-8192"):
         fallback_decision["reasoning"] = f"Agent initialization failed: {str(e)}"
         return fallback_decision
 
-def grade_documents(user_query, documents, api_key, model_name="llama3-8b-8192"):
+async def aget_retriever_decision(user_query, api_key, model_name="llama3-8b-8192", has_knowledge_base=True):
+    """Async variant of get_retriever_decision. Runs the blocking call in a worker thread."""
+    return await asyncio.to_thread(get_retriever_decision, user_query, api_key, model_name, has_knowledge_base)
+
+def grade_documents(user_query, documents, api_key, model_name="llama3-8b-8192", max_docs=5):
     """
-    Grades the relevance of retrieved documents to the user query.
-    
-    Returns: "yes" if at least one document is relevant, "no" otherwise.
+    Grades the relevance of the top retrieved documents to the user query in a single LLM call.
+
+    Input:
+        user_query (str): The user's search query.
+        documents (list): Retrieved LangChain Document objects, best match first.
+        api_key (str): Groq API Key.
+        model_name (str): The Groq model to use.
+        max_docs (int): How many of the top documents to send to the grader.
+
+    Output:
+        list: Indices (into `documents`) of the documents graded as relevant. Empty if none are.
     """
     if not documents:
-        return "no"
-        
+        return []
+
+    candidates = documents[:max_docs]
+    # Only an identical retrieved set (same order, since results are indices) is a hit
+    cache_key = (user_query, api_key, model_name, tuple(
+        (d.metadata.get('source', ''), str(d.metadata.get('page', '')), hash(d.page_content)) for d in candidates
+    ))
+    cached = _cache_get(_GRADE_CACHE, cache_key)
+    if cached is not None:
+        return list(cached)
+
     try:
-        llm = ChatGroq(temperature=0, groq_api_key=api_key, model_name=model_name)
-        grader_prompt = load_prompt("retrieval_grader.txt")
-        prompt = ChatPromptTemplate.from_template(grader_prompt)
-        parser = JsonOutputParser()
-        chain = prompt | llm | parser
+        chain = _get_grader_chain(api_key, model_name)
         
-        # We can check the top 1 or 2 docs to save time, or all.
-        # Let's check the top doc for speed/efficiency in this demo.
-        doc_txt = documents[0].page_content
+        # Truncate each document so k docs still fit comfortably in one prompt
+        docs_blob = json.dumps([{"idx": i, "text": d.page_content[:1500]} for i, d in enumerate(candidates)])
         
-        result = chain.invoke({"document": doc_txt, "question": user_query})
-        return result.get("score", "no")
+        result = chain.invoke({"documents": docs_blob, "question": user_query})
+        indices = result.get("relevant_indices", []) if isinstance(result, dict) else []
+        relevant = sorted({i for i in indices if isinstance(i, int) and 0 <= i < len(candidates)})
+        _cache_put(_GRADE_CACHE, cache_key, tuple(relevant))
+        return relevant
         
     except Exception as e:
         print(f"Grading failed: {e}")
-        # Default to yes to avoid excessive web searching if grader fails
-        return "yes"
+        # Default to all relevant to avoid excessive web searching if grader fails
+        return list(range(len(candidates)))
+
+async def agrade_documents(user_query, documents, api_key, model_name="llama3-8b-8192", max_docs=5):
+    """Async variant of grade_documents. Runs the blocking call in a worker thread."""
+    return await asyncio.to_thread(grade_documents, user_query, documents, api_key, model_name, max_docs)
@@ -2,7 +2,7 @@ import streamlit as st
 import os
 import json
 from dotenv import load_dotenv
-from .database import setup_database, load_query_history_from_db, load_chat_history_from_db
+from .database import load_query_history_from_db, load_chat_history_from_db
 from .config_utils import load_keys
 from .vector_store_manager import VectorStoreManager
 
@@ -29,9 +29,8 @@ def save_stats():
         json.dump(stats_data, f)
 
 def init_state():
-    # Always ensure DB is set up/migrated
-    setup_database()
-    
+    # The DB is set up/migrated once per process when utils.database is imported
+
     if "app_started" not in st.session_state:
         # 1. Try loading from .env explicitly (force reload to pick up changes)
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
@@ -86,8 +85,23 @@ def init_state():
             
         st.session_state.setdefault("chat_messages", load_chat_history_from_db(st.session_state.current_session_id))
         
-        # Initialize Vector Store Manager
-        if "vector_store_manager" not in st.session_state:
-             st.session_state.vector_store_manager = VectorStoreManager()
+        # Vector Store Manager is created lazily by get_vector_store_manager(),
+        # since loading the embedding model is slow and many visits never query.
              
         st.session_state.app_started = True
+
+def reset_chat(messages=None):
+    """
+    Replaces the chat history and drops the state derived from it (the Groq payload
+    history and the last user message index), so it is rebuilt for the new list
+    instead of being reused.
+    """
+    st.session_state.chat_messages = messages if messages is not None else []
+    for key in ("api_messages", "api_message_tokens", "last_user_idx"):
+        st.session_state.pop(key, None)
+
+def get_vector_store_manager():
+    """Returns the session's VectorStoreManager, creating it on first use."""
+    if "vector_store_manager" not in st.session_state:
+        st.session_state.vector_store_manager = VectorStoreManager()
+    return st.session_state.vector_store_manager
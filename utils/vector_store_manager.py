@@ -1,4 +1,7 @@
 import os
+import asyncio
+import threading
+from functools import lru_cache
 import faiss
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
@@ -17,8 +20,23 @@ class VectorStoreManager:
         self.embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
         self.vector_store_path = "faiss_index_store"
         self.memory_store_path = "faiss_memory_store"
+        # Indexing may run on a background thread while the next query searches,
+        # and FAISS indexes are not safe for concurrent add + search.
+        self._lock = threading.RLock()
+        # Same text -> same vector; lets memory lookup and retrieval share one embedding
+        self._embed_query = lru_cache(maxsize=256)(self.embeddings.embed_query)
         self.vector_store = self.load_local(self.vector_store_path) # Load if exists
         self.memory_store = self.load_local(self.memory_store_path) # Load if exists
+        # URLs of web results already in the index, so repeat searches don't re-embed them.
+        # Persisted implicitly through each web document's "url" metadata.
+        self.indexed_urls = self._load_indexed_urls()
+
+    def _load_indexed_urls(self):
+        """Collects the URLs of web documents already stored in the vector store."""
+        if self.vector_store is None:
+            return set()
+        docs = getattr(self.vector_store.docstore, "_dict", {}).values()
+        return {doc.metadata["url"] for doc in docs if doc.metadata.get("url")}
 
     def load_local(self, folder_path):
         """Loads a FAISS index from disk."""
@@ -32,10 +50,11 @@ class VectorStoreManager:
 
     def save_local(self):
         """Saves current vector stores to disk."""
-        if self.vector_store:
-            self.vector_store.save_local(self.vector_store_path)
-        if self.memory_store:
-            self.memory_store.save_local(self.memory_store_path)
+        with self._lock:
+            if self.vector_store:
+                self.vector_store.save_local(self.vector_store_path)
+            if self.memory_store:
+                self.memory_store.save_local(self.memory_store_path)
 
     def create_vector_store(self, documents):
         """
@@ -57,6 +76,7 @@ class VectorStoreManager:
     def add_documents(self, documents):
         """
         Adds documents to the existing vector store. If none exists, creates one.
+        All documents are embedded with a single batched embed_documents call.
         
         Input:
             documents (list): List of LangChain Document objects.
@@ -64,10 +84,16 @@ class VectorStoreManager:
         if not documents:
             return
 
-        if self.vector_store is None:
-            self.create_vector_store(documents)
-        else:
-            self.vector_store.add_documents(documents)
+        texts = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        vectors = self.embeddings.embed_documents(texts)
+        text_embeddings = list(zip(texts, vectors))
+
+        with self._lock:
+            if self.vector_store is None:
+                self.vector_store = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas)
+            else:
+                self.vector_store.add_embeddings(text_embeddings, metadatas=metadatas)
             self.save_local()
 
     def add_to_memory(self, query, answer):
@@ -75,22 +101,39 @@ class VectorStoreManager:
         Adds a query-answer pair to the memory store.
         """
         doc = Document(page_content=query, metadata={"answer": answer})
-        if self.memory_store is None:
-            self.memory_store = FAISS.from_documents([doc], self.embeddings)
-        else:
-            self.memory_store.add_documents([doc])
-        self.save_local()
+        with self._lock:
+            if self.memory_store is None:
+                self.memory_store = FAISS.from_documents([doc], self.embeddings)
+            else:
+                self.memory_store.add_documents([doc])
+            self.save_local()
 
-    def check_memory(self, query, threshold=0.3):
+    def embed_query_cached(self, text):
+        """
+        Embeds a query, memoizing the last 256 distinct texts.
+        
+        Input:
+            text (str): The query text.
+            
+        Output:
+            list: The query embedding vector.
+        """
+        return self._embed_query(text)
+
+    def check_memory(self, query, threshold=0.3, qvec=None):
         """
         Checks memory for a semantically similar query.
         Returns the cached answer if found and within threshold.
+        Pass a precomputed `qvec` (see embed_query_cached) to skip re-embedding the query.
         """
         if self.memory_store is None:
             return None
             
         # similarity_search_with_score returns L2 distance (lower is better)
-        docs_and_scores = self.memory_store.similarity_search_with_score(query, k=1)
+        if qvec is None:
+            qvec = self.embed_query_cached(query)
+        with self._lock:
+            docs_and_scores = self.memory_store.similarity_search_with_score_by_vector(qvec, k=1)
         
         if not docs_and_scores:
             return None
@@ -116,20 +159,54 @@ class VectorStoreManager:
             return None
         return self.vector_store.as_retriever(search_type=search_type, search_kwargs={"k": k})
 
-    def similarity_search(self, query, k=4):
+    def similarity_search(self, query, k=4, qvec=None):
         """
         Performs a raw similarity search.
         
         Input:
             query (str): The search query.
             k (int): Number of documents to return.
+            qvec (list): Optional precomputed query embedding (see embed_query_cached).
             
         Output:
             list: List of matching Document objects.
         """
         if self.vector_store is None:
             return []
-        return self.vector_store.similarity_search(query, k=k)
+        if qvec is None:
+            qvec = self.embed_query_cached(query)
+        with self._lock:
+            return self.vector_store.similarity_search_by_vector(qvec, k=k)
+
+    def similarity_search_with_score(self, query, k=4, qvec=None):
+        """
+        Performs a similarity search and returns cosine similarities alongside the documents.
+        FAISS returns squared L2 distance; MiniLM embeddings are unit-normalized, so
+        cosine similarity = 1 - distance / 2 (higher is better).
+        
+        Input:
+            query (str): The search query.
+            k (int): Number of documents to return.
+            qvec (list): Optional precomputed query embedding (see embed_query_cached).
+            
+        Output:
+            list: List of (Document, similarity) tuples, best match first.
+        """
+        if self.vector_store is None:
+            return []
+        if qvec is None:
+            qvec = self.embed_query_cached(query)
+        with self._lock:
+            docs_and_distances = self.vector_store.similarity_search_with_score_by_vector(qvec, k=k)
+        return [(doc, 1 - float(distance) / 2) for doc, distance in docs_and_distances]
+
+    async def asimilarity_search_with_score(self, query, k=4, qvec=None):
+        """
+        Async variant of similarity_search_with_score. Runs the FAISS lookup in a worker thread.
+        """
+        if self.vector_store is None:
+            return []
+        return await asyncio.to_thread(self.similarity_search_with_score, query, k, qvec)
 
 # Simple singleton pattern for the app session
 if "vector_store_manager" not in os.environ:
@@ -1,23 +1,64 @@
 import streamlit as st
 import streamlit.components.v1 as components
+import asyncio
 import json
+import multiprocessing
 import os
-from utils.api_clients import run_tavily_search, ask_groq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils.api_clients import run_tavily_search, ask_groq_stream
 from utils.logging_utils import log_search, log_llm_call
 from utils.text_utils import count_tokens
 from utils.database import log_interaction, find_similar_interaction, update_interaction_rating
 from utils.prompt_loader import load_prompt
-from utils.document_processor import process_uploaded_file
-from utils.vector_store_manager import VectorStoreManager
+from utils.document_processor import process_uploaded_file, process_file_bytes
+from utils.state_manager import get_vector_store_manager
 from langchain_core.documents import Document
-from utils.retriever_agent import get_retriever_decision, grade_documents
+from utils.retriever_agent import quick_route, get_retriever_decision, grade_documents, aget_retriever_decision, agrade_documents
 
 from utils.constants import RetrievalStrategy
 
-# Initialize Vector Store Manager in Session State
-if "vector_store_manager" not in st.session_state:
-    st.session_state.vector_store_manager = VectorStoreManager()
 
+# Older history is hidden behind a toggle so each rerun only redraws a bounded window
+MAX_VISIBLE_MESSAGES = 40
+
+# Badge color per retrieval strategy (anything else, e.g. Direct LLM, is blue)
+_BADGE = {
+    RetrievalStrategy.WEB_SEARCH.value: "red",
+    RetrievalStrategy.VECTOR_BASED.value: "green",
+    RetrievalStrategy.HYBRID.value: "orange",
+}
+
+def _log_background_error(future):
+    """Surfaces exceptions from fire-and-forget background tasks in the server log."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Background task failed: {future.exception()}")
+
+def submit_background(fn, *args):
+    """
+    Runs work that the current answer doesn't depend on (indexing, memory) in the
+    session's thread pool. The future is kept so a later turn can wait on it if needed.
+    Only pass callables that don't touch st.* APIs, since they run off the script thread.
+    """
+    if "background_executor" not in st.session_state:
+        st.session_state.background_executor = ThreadPoolExecutor(max_workers=4)
+        st.session_state.background_futures = []
+    future = st.session_state.background_executor.submit(fn, *args)
+    future.add_done_callback(_log_background_error)
+    st.session_state.background_futures = [f for f in st.session_state.background_futures if not f.done()] + [future]
+    return future
+
+def _unmark_urls_on_failure(vector_store_manager, urls):
+    """Returns a done-callback that forgets `urls` as indexed if the background add failed, so a later turn retries them."""
+    def callback(future):
+        if future.cancelled() or future.exception() is not None:
+            vector_store_manager.indexed_urls.difference_update(urls)
+    return callback
+
+def message_tokens(msg):
+    """Returns the token count of a chat message, computing it once and caching it on the dict."""
+    if "n_tokens" not in msg:
+        msg["n_tokens"] = count_tokens(msg["content"])
+    return msg["n_tokens"]
 
 def check_pending_query():
     if "pending_query" in st.session_state and st.session_state.pending_query:
@@ -26,6 +67,167 @@ def check_pending_query():
         return q
     return None
 
+# Relevance gate on the top retrieved doc's cosine similarity: confident matches skip
+# the LLM grader, clear misses go straight to web search, only the middle band is graded.
+GRADE_ACCEPT_SCORE = 0.85
+GRADE_REJECT_SCORE = 0.4
+
+def _score_gate(scores):
+    """Returns relevant indices when the scores alone decide relevance, else None (needs grading)."""
+    top_score = scores[0] if scores else 0
+    if top_score >= GRADE_ACCEPT_SCORE:
+        return [i for i, score in enumerate(scores) if score >= GRADE_REJECT_SCORE]
+    if top_score < GRADE_REJECT_SCORE:
+        return []
+    return None
+
+def _retrieve_and_grade(user_prompt, api_key, model_name, vector_store_manager, qvec=None):
+    """Vector search, then the score gate, falling back to the LLM grader for the middle band."""
+    docs_and_scores = vector_store_manager.similarity_search_with_score(user_prompt, k=4, qvec=qvec)
+    docs = [doc for doc, _ in docs_and_scores]
+    relevant_indices = _score_gate([score for _, score in docs_and_scores])
+    if relevant_indices is None:
+        relevant_indices = grade_documents(user_prompt, docs, api_key, model_name)
+    return docs, relevant_indices
+
+async def _route_and_retrieve_async(user_prompt, api_key, model_name, vector_store_manager, qvec=None):
+    """
+    Runs the LLM router concurrently with vector search; grading starts as soon as the
+    search returns, without waiting on the router.
+    """
+    async def retrieve_and_grade():
+        docs_and_scores = await vector_store_manager.asimilarity_search_with_score(user_prompt, k=4, qvec=qvec)
+        docs = [doc for doc, _ in docs_and_scores]
+        relevant_indices = _score_gate([score for _, score in docs_and_scores])
+        if relevant_indices is None:
+            relevant_indices = await agrade_documents(user_prompt, docs, api_key, model_name)
+        return docs, relevant_indices
+
+    return await asyncio.gather(
+        aget_retriever_decision(user_prompt, api_key, model_name, vector_store_manager.vector_store is not None),
+        retrieve_and_grade()
+    )
+
+def _route_and_retrieve(user_prompt, api_key, model_name, vector_store_manager, qvec=None):
+    """
+    Returns (agent_decision, (docs, relevant_indices)).
+    Local routing decisions are taken first, so Direct LLM skips retrieval and grading,
+    and other strategies skip the router; only LLM routing is overlapped with retrieval.
+    Falls back to sequential calls when an event loop is already running.
+    """
+    has_knowledge_base = vector_store_manager.vector_store is not None
+    agent_decision = quick_route(user_prompt, has_knowledge_base)
+    if agent_decision is None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(_route_and_retrieve_async(user_prompt, api_key, model_name, vector_store_manager, qvec))
+        agent_decision = get_retriever_decision(user_prompt, api_key, model_name, has_knowledge_base)
+
+    if agent_decision['strategy'] == RetrievalStrategy.DIRECT_LLM.value:
+        return agent_decision, ([], [])
+    return agent_decision, _retrieve_and_grade(user_prompt, api_key, model_name, vector_store_manager, qvec)
+
+def render_feedback_buttons(interaction_id):
+    """Renders 👍/👎 rating buttons for a logged interaction."""
+    feedback_key_base = f"feedback_{interaction_id}"
+    col1, col2, _ = st.columns([1, 1, 10])
+    with col1:
+        if st.button("👍", key=f"{feedback_key_base}_up"):
+            update_interaction_rating(interaction_id, 1)
+            st.toast("Thanks!")
+    with col2:
+        if st.button("👎", key=f"{feedback_key_base}_down"):
+            update_interaction_rating(interaction_id, -1)
+
+def render_message(i, msg, is_last_user=False):
+    """Renders one chat history message; the last user message gets edit/rerun buttons."""
+    with st.chat_message(msg["role"]):
+        if "source" in msg: st.caption(msg["source"])
+        
+
+        if "retrieval_strategy" in msg:
+            strategy = msg["retrieval_strategy"]
+            badge_color = _BADGE.get(strategy, "blue")
+            st.markdown(f":{badge_color}[**[{strategy}]**]")
+
+        if is_last_user:
+            # Use columns to place text and edit/rerun buttons side-by-side
+            c1, c2 = st.columns([0.85, 0.15])
+            with c1:
+                st.markdown(msg["content"])
+            with c2:
+                # Nested columns for the buttons to keep them close
+                b1, b2 = st.columns([1, 1])
+                with b1:
+                    if st.button("✏️", key=f"edit_btn_{i}", help="Edit Query"):
+                        st.session_state.editing_query = msg["content"]
+                        st.rerun()
+                with b2:
+                     if st.button("🔄", key=f"rerun_btn_{i}", help="Rerun Query"):
+                        st.session_state.pending_query = msg["content"]
+                        st.rerun()
+        else:
+            st.markdown(msg["content"])
+
+        # Render Sources at the bottom if available
+        if "sources" in msg and msg["sources"]:
+            with st.expander("📚 Sources & References", expanded=False):
+                for idx, src in enumerate(msg["sources"]):
+                    # Handle Web Results (Dict) vs Documents (Object)
+                    if isinstance(src, dict):
+                        # Web Result
+                        st.markdown(f"**{idx+1}. [{src.get('title', 'Link')}]({src.get('url', '#')})**")
+                        st.caption(src.get('content', '')[:150] + "...")
+                    else:
+                        # Document Object
+                        meta = src.metadata
+                        source_name = meta.get('source', 'Unknown Document')
+                        page = meta.get('page', 'N/A')
+                        st.markdown(f"**{idx+1}. {source_name}** (Page {page})")
+                        st.caption(src.page_content[:150] + "...")
+                    st.divider()
+
+
+        if msg["role"] == "assistant" and "interaction_id" in msg:
+            render_feedback_buttons(msg["interaction_id"])
+
+
+def last_user_index(messages):
+    """
+    Returns the index of the last user message (-1 if none).
+    Cached in session state, updated at append time and dropped by reset_chat().
+    """
+    if "last_user_idx" in st.session_state:
+        return st.session_state.last_user_idx
+    idx = -1
+    for k in range(len(messages) - 1, -1, -1):
+        if messages[k]["role"] == "user":
+            idx = k
+            break
+    st.session_state.last_user_idx = idx
+    return idx
+
+def _sync_api_messages(messages):
+    """
+    Builds the Groq payload history (and its token counts) from chat_messages if it
+    was dropped by reset_chat(), e.g. on session switch or clear. A no-op otherwise.
+    """
+    if "api_messages" in st.session_state and "api_message_tokens" in st.session_state:
+        return
+    st.session_state.api_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    st.session_state.api_message_tokens = [message_tokens(m) for m in messages]
+
+def append_message(msg):
+    """Appends a message to the chat history, keeping the derived caches in sync."""
+    messages = st.session_state.chat_messages
+    _sync_api_messages(messages)
+    messages.append(msg)
+    st.session_state.api_messages.append({"role": msg["role"], "content": msg["content"]})
+    st.session_state.api_message_tokens.append(message_tokens(msg))
+    if msg["role"] == "user":
+        st.session_state.last_user_idx = len(messages) - 1
+
 def render_page():
     """
     Renders the RAG Agent page.
@@ -39,77 +241,17 @@ def render_page():
 
 
     user_prompt = None # Initialize to avoid UnboundLocalError
+    # The edit form and chat input were skipped/left stale this frame, so redraw after the turn
+    rerun_after_turn = False
 
-    # Find the index of the last user message to show edit button
-    last_user_msg_index = -1
-    for i in range(len(st.session_state.chat_messages) - 1, -1, -1):
-        if st.session_state.chat_messages[i]["role"] == "user":
-            last_user_msg_index = i
-            break
-
-    # Display chat history
-    for i, msg in enumerate(st.session_state.chat_messages):
-        with st.chat_message(msg["role"]):
-            if "source" in msg: st.caption(msg["source"])
-            
-
-            if "retrieval_strategy" in msg:
-                strategy = msg["retrieval_strategy"]
-                badge_color = "blue"
-                if strategy == RetrievalStrategy.WEB_SEARCH.value: badge_color = "red"
-                elif strategy == RetrievalStrategy.VECTOR_BASED.value: badge_color = "green"
-                elif strategy == RetrievalStrategy.HYBRID.value: badge_color = "orange"
-                
-                st.markdown(f":{badge_color}[**[{strategy}]**]")
-
-            if i == last_user_msg_index and msg["role"] == "user":
-                # Use columns to place text and edit/rerun buttons side-by-side
-                c1, c2 = st.columns([0.85, 0.15])
-                with c1:
-                    st.markdown(msg["content"])
-                with c2:
-                    # Nested columns for the buttons to keep them close
-                    b1, b2 = st.columns([1, 1])
-                    with b1:
-                        if st.button("✏️", key=f"edit_btn_{i}", help="Edit Query"):
-                            st.session_state.editing_query = msg["content"]
-                            st.rerun()
-                    with b2:
-                         if st.button("🔄", key=f"rerun_btn_{i}", help="Rerun Query"):
-                            st.session_state.pending_query = msg["content"]
-                            st.rerun()
-            else:
-                st.markdown(msg["content"])
-
-            # Render Sources at the bottom if available
-            if "sources" in msg and msg["sources"]:
-                with st.expander("📚 Sources & References", expanded=False):
-                    for idx, src in enumerate(msg["sources"]):
-                        # Handle Web Results (Dict) vs Documents (Object)
-                        if isinstance(src, dict):
-                            # Web Result
-                            st.markdown(f"**{idx+1}. [{src.get('title', 'Link')}]({src.get('url', '#')})**")
-                            st.caption(src.get('content', '')[:150] + "...")
-                        else:
-                            # Document Object
-                            meta = src.metadata
-                            source_name = meta.get('source', 'Unknown Document')
-                            page = meta.get('page', 'N/A')
-                            st.markdown(f"**{idx+1}. {source_name}** (Page {page})")
-                            st.caption(src.page_content[:150] + "...")
-                        st.divider()
-
-
-            if msg["role"] == "assistant" and "interaction_id" in msg:
-                feedback_key_base = f"feedback_{msg['interaction_id']}"
-                col1, col2, _ = st.columns([1, 1, 10])
-                with col1:
-                    if st.button("👍", key=f"{feedback_key_base}_up"):
-                        update_interaction_rating(msg["interaction_id"], 1)
-                        st.toast("Thanks!")
-                with col2:
-                    if st.button("👎", key=f"{feedback_key_base}_down"):
-                        update_interaction_rating(msg["interaction_id"], -1)
+    # Display chat history (only a trailing window unless older messages are requested)
+    messages = st.session_state.chat_messages
+    last_user_msg_index = last_user_index(messages)
+    start = max(0, len(messages) - MAX_VISIBLE_MESSAGES)
+    if start and st.toggle(f"Show {start} older messages", key="show_older_messages"):
+        start = 0
+    for i in range(start, len(messages)):
+        render_message(i, messages[i], i == last_user_msg_index)
 
 
     pending_q = check_pending_query()
@@ -134,15 +276,25 @@ def render_page():
             if new_files:
                 with st.spinner(f"Processing {len(new_files)} new file(s)..."):
                     try:
-                        all_docs = []
-                        for uploaded_file in new_files:
-                            docs = process_uploaded_file(uploaded_file)
-                            all_docs.extend(docs)
-                            # Mark as processed
-                            st.session_state.processed_files.add(uploaded_file.name)
+                        if len(new_files) == 1:
+                            results = [process_uploaded_file(new_files[0])]
+                        else:
+                            # Parsers (pypdf etc.) are pure Python and hold the GIL, so files are
+                            # parsed in worker processes. Spawned rather than forked, as this
+                            # server process runs threads (DB writer, background executor).
+                            workers = min(8, len(new_files), os.cpu_count() or 1)
+                            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+                                results = list(ex.map(
+                                    process_file_bytes,
+                                    [f.name for f in new_files],
+                                    [f.getvalue() for f in new_files]
+                                ))
+                        all_docs = [d for docs in results for d in docs]
+                        # Mark as processed
+                        st.session_state.processed_files.update(f.name for f in new_files)
                         
                         if all_docs:
-                            st.session_state.vector_store_manager.add_documents(all_docs)
+                            get_vector_store_manager().add_documents(all_docs)
                             st.success(f"Indexed {len(all_docs)} chunks!")
                         else:
                             st.warning("No text found.")
@@ -180,6 +332,7 @@ def render_page():
                 if run:
                     user_prompt = edited_query
                     del st.session_state.editing_query
+                    rerun_after_turn = True
                     # Clean slate for rerun context if needed
 
     else:
@@ -189,30 +342,42 @@ def render_page():
         user_prompt = pending_q
 
     if user_prompt:
-        st.session_state.chat_messages.append({"role": "user", "content": user_prompt})
+        append_message({"role": "user", "content": user_prompt, "n_tokens": count_tokens(user_prompt)})
         with st.chat_message("user"):
             st.markdown(user_prompt)
 
         with st.chat_message("assistant"):
             
+            # Embed the prompt once; memory lookup and document retrieval share the vector
+            vsm = get_vector_store_manager()
+            qvec = None
+            if vsm.memory_store is not None or vsm.vector_store is not None:
+                qvec = vsm.embed_query_cached(user_prompt)
+
             # 1. Check Semantic Memory First
-            cached_response = st.session_state.vector_store_manager.check_memory(user_prompt)
+            cached_response = vsm.check_memory(user_prompt, qvec=qvec)
             if cached_response:
                 st.success("⚡ Accessed from Memory")
                 st.markdown(cached_response)
-                st.session_state.chat_messages.append({
+                append_message({
                     "role": "assistant", 
                     "content": cached_response,
-                    "source": "Memory Cache"
+                    "source": "Memory Cache",
+                    "n_tokens": count_tokens(cached_response)
                 })
-                st.rerun()
+                # Already rendered in place; a rerun would just redo the whole page
+                if rerun_after_turn:
+                    st.rerun()
+                return
 
-            # 2. Intelligent Agent Classification (Router)
-            with st.spinner("Analyzing query..."):
-                agent_decision = get_retriever_decision(
+            # 2. Intelligent Agent Classification (Router), overlapped with Vector Search + Grading
+            with st.spinner("Analyzing query and searching documents..."):
+                agent_decision, (docs, relevant_indices) = _route_and_retrieve(
                     user_prompt, 
                     st.session_state.get("GROQ_API_KEY"),
-                    st.session_state.settings.get("groq_model", "llama3-8b-8192")
+                    st.session_state.settings.get("groq_model", "llama3-8b-8192"),
+                    vsm,
+                    qvec
                 )
             
             context_text = ""
@@ -227,28 +392,13 @@ def render_page():
             else:
                 # Proceed with Dynamic RAG (Vector -> Grade -> Web)
                 
-                # A. Attempt Vector Search
-                docs = []
+                # A/B. Vector Search results, graded (all top-k docs in one call) alongside the router
                 final_strategy = RetrievalStrategy.VECTOR_BASED.value # Default start for RAG
-
-                if st.session_state.vector_store_manager.vector_store is not None:
-                    with st.spinner("Searching Vector Database..."):
-                        docs = st.session_state.vector_store_manager.similarity_search(user_prompt, k=4)
-                
-                # B. Grade Results
-                grade = "no"
-                if docs:
-                    with st.spinner("Grading retrieved documents..."):
-                        grade = grade_documents(
-                            user_prompt, 
-                            docs, 
-                            st.session_state.get("GROQ_API_KEY"),
-                            st.session_state.settings.get("groq_model", "llama3-8b-8192")
-                        )
+                docs = [docs[i] for i in relevant_indices]
                 
                 # C. Decision: Vector vs Web
-                if grade == "yes":
-                    st.toast("Relevance Grade: ✅ Relevant")
+                if docs:
+                    st.toast(f"Relevance Grade: ✅ {len(docs)} Relevant")
                     final_strategy = RetrievalStrategy.VECTOR_BASED.value
                     context_text += "\n\n**Retrieved Documents:**\n"
                     for doc in docs:
@@ -276,45 +426,55 @@ def render_page():
                             context_text += f"\n\n**Web Search Results:**\n{web_context}\n"
                             
                             # INDEXING STEP: Convert Web Results to Documents and Add to Vector Store
-                            new_docs = []
-                            for r in web_results:
-                                sources.append(r) # For display
-                                # Create a Document for indexing
-                                doc_content = f"Title: {r['title']}\nURL: {r['url']}\nContent: {r['content']}"
-                                new_doc = Document(
-                                    page_content=doc_content, 
+                            sources.extend(web_results) # For display
+                            # Skip URLs already in the index (and repeats within this batch)
+                            unseen = {r['url']: r for r in web_results if r['url'] not in vsm.indexed_urls}
+                            new_docs = [
+                                Document(
+                                    page_content=f"Title: {r['title']}\nURL: {r['url']}\nContent: {r['content']}", 
                                     metadata={"source": r['title'], "url": r['url'], "page": "Web"}
                                 )
-                                new_docs.append(new_doc)
+                                for r in unseen.values()
+                            ]
+                            # Marked now so concurrent turns don't index them twice; unmarked if the add fails
+                            vsm.indexed_urls.update(unseen)
                             
                             if new_docs:
-                                st.session_state.vector_store_manager.add_documents(new_docs)
-                                st.toast(f"Indexed {len(new_docs)} web results for future use.")
+                                # One call, so all results are embedded in a single batch.
+                                # Not needed for this answer, so it overlaps with generation.
+                                future = submit_background(vsm.add_documents, new_docs)
+                                future.add_done_callback(_unmark_urls_on_failure(vsm, list(unseen)))
+                                st.toast(f"Indexing {len(new_docs)} web results for future use.")
 
                 # D. Prepare RAG Prompt
                 rag_template = load_prompt("rag_response_system.txt")
                 system_prompt = rag_template.format(context_text=context_text)
             
-            messages = [{"role": "system", "content": system_prompt}] + [
-                {"role": m["role"], "content": m["content"]} for m in st.session_state.chat_messages if m["role"] != "system"
-            ]
+            # Sliding window over the conversation keeps prompt size bounded as the chat grows
+            # (api_messages is maintained at append time, so no per-turn rebuild of the history)
+            history_turns = st.session_state.settings.get("history_turns", 12)
+            _sync_api_messages(st.session_state.chat_messages)
+            messages = [{"role": "system", "content": system_prompt}] + st.session_state.api_messages[-history_turns:]
+            # Per-message counts are cached, so only the new system prompt is tokenized each turn
+            prompt_tokens = count_tokens(system_prompt) + sum(st.session_state.api_message_tokens[-history_turns:])
 
             provider = "Groq (Web-based)"
             model = st.session_state.settings.get("groq_model", "llama-3.3-70b-versatile")
             
-            with st.spinner("Generating answer..."):
-                response_text = ask_groq(messages, model, st.session_state.settings.get("temperature", 0.5))
-                st.markdown(response_text)
-                
-                # Render sources immediately for current turn
-                if sources:
-                     with st.expander("📚 Sources & References", expanded=False):
-                        for idx, src in enumerate(sources):
-                            if isinstance(src, dict):
-                                st.markdown(f"**{idx+1}. [{src.get('title', 'Link')}]({src.get('url', '#')})**")
-                            else:
-                                meta = src.metadata
-                                st.markdown(f"**{idx+1}. {meta.get('source', 'Doc')}**")
+            # Stream tokens so the user sees the answer as soon as the first one arrives
+            response_text = st.write_stream(ask_groq_stream(messages, model, st.session_state.settings.get("temperature", 0.5)))
+            if not isinstance(response_text, str):
+                response_text = "".join(str(part) for part in response_text)
+            
+            # Render sources immediately for current turn
+            if sources:
+                 with st.expander("📚 Sources & References", expanded=False):
+                    for idx, src in enumerate(sources):
+                        if isinstance(src, dict):
+                            st.markdown(f"**{idx+1}. [{src.get('title', 'Link')}]({src.get('url', '#')})**")
+                        else:
+                            meta = src.metadata
+                            st.markdown(f"**{idx+1}. {meta.get('source', 'Doc')}**")
 
             # Log Interaction
             interaction_id = log_interaction(
@@ -326,18 +486,23 @@ def render_page():
                 session_id=st.session_state.get("current_session_id", "default")
             )
             
-            # Save to Memory
-            st.session_state.vector_store_manager.add_to_memory(user_prompt, response_text)
+            # Save to Memory (in the background; only future turns read it)
+            submit_background(vsm.add_to_memory, user_prompt, response_text)
 
-            st.session_state.chat_messages.append({
+            append_message({
                 "role": "assistant", 
                 "content": response_text,
                 "source": f"Groq ({model})", 
+                "n_tokens": count_tokens(response_text),
                 "sources": sources,
                 "retrieval_strategy": final_strategy,
                 "interaction_id": interaction_id
             })
+            render_feedback_buttons(interaction_id)
             
-            log_llm_call(provider, model, count_tokens(str(messages)), count_tokens(response_text))
+            log_llm_call(provider, model, prompt_tokens, count_tokens(response_text))
             
-            st.rerun()
+            # The sidebar was drawn before this turn; a new chat's first turn reruns so the
+            # session list and "Delete current" pick it up. Other turns are already in place.
+            if rerun_after_turn or not st.session_state.get("current_session_listed", True):
+                st.rerun()
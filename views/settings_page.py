@@ -1,5 +1,6 @@
 import streamlit as st
 from utils.config_utils import save_keys
+from utils.database import optimize_database
 
 
 def render_page():
@@ -37,10 +38,22 @@ def render_page():
         selected_temp = st.slider("LLM Temperature", min_value=0.0, max_value=1.0, value=st.session_state.settings.get("temperature", 0.5), step=0.05)
         selected_depth = st.selectbox("Default Search Depth (1-2: Basic, 3-5: Adv)", options=[1, 2, 3, 4, 5], index=st.session_state.settings.get("tavily_depth", 5) - 1)
         selected_count = st.slider("Search Result Count", min_value=1, max_value=10, value=st.session_state.settings.get("search_count", 5))
+        selected_history = st.slider("Chat History Window (messages sent to the LLM)", min_value=2, max_value=50, value=st.session_state.settings.get("history_turns", 12), step=2)
         
         if st.form_submit_button("Save All Settings", width="stretch"):
             st.session_state.settings["groq_model"] = selected_groq
             st.session_state.settings["temperature"] = selected_temp
             st.session_state.settings["tavily_depth"] = selected_depth
             st.session_state.settings["search_count"] = selected_count
+            st.session_state.settings["history_turns"] = selected_history
             st.success("Settings saved!")
+
+
+    st.divider()
+
+
+    st.header("Maintenance")
+    if st.button("Optimize Database"):
+        with st.spinner("Refreshing query planner statistics..."):
+            optimize_database()
+        st.success("Database optimized!")